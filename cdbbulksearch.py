@@ -1,16 +1,93 @@
-import asyncio, argparse, concurrent.futures, gzip, random, signal, sys
+import asyncio, argparse, concurrent.futures, functools, gzip, hashlib, io, os
+import multiprocessing, pickle, random, re, shutil, signal, sys, tempfile
+import threading, time
 import chess, chess.pgn
 import cdbsearch
-from io import StringIO
 from multiprocessing import freeze_support, active_children
 from collections import deque
 
+try:
+    # use the much faster ISA-L based decompression, if available
+    from isal import igzip_threaded
+
+    gzip_open = igzip_threaded.open
+except ImportError:
+    gzip_open = gzip.open
+
+# parallel decompression of large gzip files, if available
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+try:
+    import pgzip
+except ImportError:
+    pgzip = None
+
+# compression of the cached EPD lists, if available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 CDB_EGTB = 7
 
+# valid UCI move tokens in the extended "moves m1 m2 m3" syntax
+MOVE_RE = re.compile(r"[a-h][1-8][a-h][1-8][qrbn]?")
+
+# comments in PGN movetext, an unterminated one runs until the end of the game
+PGN_COMMENT_RE = re.compile(r"\{[^}]*\}?|;[^\n]*")
+
+# the same few UCI tokens appear in most lines, so parse each of them only once
+move_from_uci = functools.lru_cache(maxsize=8192)(chess.Move.from_uci)
+
+# older versions of python-chess do not use int.bit_count even where it exists
+popcount = int.bit_count if sys.version_info >= (3, 10) else chess.popcount
+
+# increase whenever the EPDs loaded from unchanged files change, to ignore old caches
+EPDS_CACHE_VERSION = 1
+
+BUFFER_SIZE = 1 << 22  # read buffer for (compressed) input files
+
+
+class QueueWriter:
+    """a minimal file-like object that sends each line written to it to a queue"""
+
+    def __init__(self, queue, taskId):
+        self.queue = queue
+        self.taskId = taskId
+        self.buffer = ""
+
+    def write(self, s):
+        self.buffer += s
+        if "\n" in s:
+            self.flush()
+        return len(s)
+
+    def flush(self):
+        if self.buffer:
+            self.queue.put((self.taskId, self.buffer))
+            self.buffer = ""
 
-def wrapcdbsearch(
-    epd,
-    depthLimit,
+
+# set in each worker process by init_worker, so that they are not sent per task
+outputQueue, searchArgs = None, {}
+
+
+def join_process_group(pgid):
+    """moves the calling process into the process group stored in pgid"""
+    with pgid.get_lock():
+        if pgid.value == 0:
+            # the first worker becomes the leader of a new group
+            os.setpgid(0, 0)
+            pgid.value = os.getpid()
+        else:
+            os.setpgid(0, pgid.value)
+
+
+def init_worker(
+    queue,
+    pgid,
     timeLimit,
     concurrency,
     evalDecay,
@@ -20,132 +97,485 @@ def wrapcdbsearch(
     user,
     suppressErrors,
 ):
+    global outputQueue, searchArgs
+    if pgid is not None:
+        join_process_group(pgid)
+        # a forked worker inherits the handlers of the main process
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    outputQueue = queue
+    searchArgs = dict(
+        timeLimit=timeLimit,
+        concurrency=concurrency,
+        evalDecay=evalDecay,
+        cursedWins=cursedWins,
+        TBsearch=TBsearch,
+        proveMates=proveMates,
+        user=user,
+        suppressErrors=suppressErrors,
+    )
+
+
+def consume_output(queue, output, finished, condition):
+    """moves the output of the workers from the queue into the per task buffers"""
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        i, text = item
+        with condition:
+            if text is None:
+                finished.add(i)
+            else:
+                output.setdefault(i, []).append(text)
+            condition.notify()
+
+
+def wrapcdbsearch(taskId, epd, depthLimit):
     old_stdout = sys.stdout
-    sys.stdout = mystdout = StringIO()
+    sys.stdout = mystdout = QueueWriter(outputQueue, taskId)
     try:
-        asyncio.run(
-            cdbsearch.cdbsearch(
-                epd=epd,
-                depthLimit=depthLimit,
-                timeLimit=timeLimit,
-                concurrency=concurrency,
-                evalDecay=evalDecay,
-                cursedWins=cursedWins,
-                TBsearch=TBsearch,
-                proveMates=proveMates,
-                user=user,
-                suppressErrors=suppressErrors,
-            )
-        )
+        asyncio.run(cdbsearch.cdbsearch(epd=epd, depthLimit=depthLimit, **searchArgs))
     except Exception as ex:
         print(f' error: while searching EPD "{epd}" caught exception "{ex}"')
+    mystdout.flush()
     sys.stdout = old_stdout
-    return mystdout.getvalue()
 
 
-def open_file_rt(filename):
+def open_gzip_rb(filename, gzipThreads=1):
+    # use several threads for the decompression if possible
+    if gzipThreads > 1:
+        if rapidgzip is not None:
+            return rapidgzip.open(filename, parallelization=gzipThreads)
+        if pgzip is not None:
+            return pgzip.open(filename, "rb", thread=gzipThreads, blocksize=2**22)
+    return gzip_open(filename, "rb")
+
+
+def open_file_rb(filename):
+    # large buffered reads, and let the kernel know that it can read ahead
+    f = open(filename, "rb", buffering=BUFFER_SIZE)
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass  # e.g. a pipe, for which the hint does not apply
+    return f
+
+
+def open_file_rt(filename, gzipThreads=1, isGz=None):
     # allow reading text files either plain or in gzip format
-    open_func = gzip.open if filename.endswith(".gz") else open
-    return open_func(filename, "rt")
+    if isGz is None:
+        isGz = filename.lower().endswith(".gz")
+    if isGz:
+        f = open_gzip_rb(filename, gzipThreads)
+        f = io.BufferedReader(f, buffer_size=BUFFER_SIZE)
+    else:
+        f = open_file_rb(filename)
+    return io.TextIOWrapper(f, encoding="utf-8", errors="replace")
 
 
-def load_epds(filename, plyBegin=-1, plyEnd=None, TBsearch=False):
-    """returns a list of unique EPDs found in the given file"""
-    epdlist = []
-    if filename.endswith(".pgn") or filename.endswith(".pgn.gz"):
-        pgn = open_file_rt(filename)
-        while True:
-            game = chess.pgn.read_game(pgn)
-            if game is None:
+def in_pgn_comment(line, inComment):
+    """returns if a PGN comment is still open at the end of the movetext line"""
+    pos = 0
+    while True:
+        if inComment:
+            pos = line.find("}", pos)
+            if pos < 0:
+                return True
+            pos, inComment = pos + 1, False
+        else:
+            m = PGN_COMMENT_RE.search(line, pos)
+            if m is None or line[m.start()] == ";":
+                return False
+            pos, inComment = m.start() + 1, True
+
+
+def read_pgn_games(pgn):
+    """yields the tag and movetext lines of the games in the given PGN stream"""
+    # this splits the stream into games exactly like chess.pgn.read_game
+    line = pgn.readline()
+    while True:
+        line = line.lstrip("\ufeff")
+        while line.isspace() or line.startswith(("%", ";")):
+            line = pgn.readline()
+        if not line:
+            return
+        tags, movetext, empty = [], [], False
+        while line:
+            if line.startswith(("%", ";")):
+                pass
+            elif line.isspace() and not empty:
+                empty = True  # allow one empty line between tags
+            elif line.startswith("["):
+                tags.append(line)
+                empty = False
+            else:
                 break
-            epd = game.board().fen()  # include potential move counters
-            epdMoves = " moves"
-            for m in game.mainline_moves():
-                epdMoves += f" {m}"
-            if epdMoves != " moves":
-                epd += epdMoves
-            epdlist.append(epd)
-        print(f"Loaded {len(epdlist)} (opening) lines from file {filename}.")
-    else:
-        with open_file_rt(filename) as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    if line.startswith("#"):  # ignore comments
-                        continue
-                    line = line.split(";")[0]  # ignore epd opcodes
-                    epd, _, moves = line.partition("moves")
-                    epd = epd.split()[:6]  # include potential move counters
-                    if len(epd) == 6 and not (
-                        epd[4].isnumeric() and epd[5].isnumeric()
-                    ):
-                        epd = epd[:4]
-                    epd = " ".join(epd)
-                    epdMoves = " moves"
-                    for m in moves.split():
-                        if (
-                            len(m) < 4
-                            or len(m) > 5
-                            or not {m[0], m[2]}.issubset(set("abcdefgh"))
-                            or not {m[1], m[3]}.issubset(set("12345678"))
-                            or (len(m) == 5 and not m[4] in "qrbn")
-                        ):
-                            break
-                        epdMoves += f" {m}"
-                    if epdMoves != " moves":
-                        epd += epdMoves
-                    epdlist.append(epd)
-        print(f"Loaded {len(epdlist)} (extended) EPDs from file {filename}.")
-
-    epds = set()  # use a set to filter duplicates
-    for epd in epdlist:
-        epd, _, moves = epd.partition(" moves")
-        moves = [None] + moves.split()  # to be able to use plyBegin=0 for epd
-        plyB = (
-            0
-            if plyBegin is None
-            else max(0, plyBegin + len(moves))
-            if plyBegin < 0
-            else min(plyBegin, len(moves))
-        )
-        plyE = (
-            len(moves)
-            if plyEnd is None
-            else max(0, plyEnd + len(moves))
-            if plyEnd < 0
-            else min(plyEnd, len(moves))
-        )
-        board = chess.Board(epd)
+            line = pgn.readline()
+        inComment = False
+        while line:
+            if not inComment:
+                if line.isspace():
+                    break
+                if line.startswith(("%", ";")):
+                    line = pgn.readline()
+                    continue
+            movetext.append(line)
+            inComment = in_pgn_comment(line, inComment)
+            line = pgn.readline()
+        yield tags, movetext
+        line = pgn.readline()
+
+
+def mainline_sans(movetext):
+    """returns the SAN tokens in the movetext, or None if it has variations"""
+    sans = []
+    text = PGN_COMMENT_RE.sub(" ", "".join(movetext))
+    for m in chess.pgn.MOVETEXT_REGEX.finditer(text):
+        if m.group(1):
+            sans.append(m.group(1))
+        elif m.group(5) or m.group(6):
+            return None
+    return sans
+
+
+def read_pgn_game(lines):
+    """returns the (epd, moves) pair for the PGN game, as parsed by python-chess"""
+    game = chess.pgn.read_game(io.StringIO("".join(lines)))
+    # include potential move counters
+    return game.board().fen(), list(game.mainline_moves())
+
+
+def read_pgn_lines(pgn):
+    """yields (epd, moves) pairs for the (opening) lines in the given PGN stream"""
+    # Only the mainline moves are needed, so rather than building the full game
+    # tree with chess.pgn.read_game, parse the SAN tokens on a board that is
+    # reused from the previous line. Games with variations, chess variants or
+    # errors are left to python-chess.
+    board, fen, sans = None, None, []  # board, FEN tag and SANs of the previous line
+    for tags, movetext in read_pgn_games(pgn):
+        headers = {}
+        for tag in tags:
+            m = chess.pgn.TAG_REGEX.match(tag)
+            if m:
+                headers[m.group(1)] = m.group(2)
+        gameSans = mainline_sans(movetext)
+        if gameSans is None or "Variant" in headers:
+            board = None
+            yield read_pgn_game(tags + movetext)
+            continue
+        gameFen = headers.get("FEN", chess.STARTING_FEN)
+        try:
+            if board is None or gameFen != fen:
+                board, fen, sans = chess.Board(gameFen), gameFen, []
+                if board.has_chess960_castling_rights():
+                    raise ValueError("chess960 castling rights")
+                epd = board.fen()
+            # the same SAN in the same position is the same move
+            shared = 0
+            for m, n in zip(sans, gameSans):
+                if m != n:
+                    break
+                shared += 1
+            while len(board.move_stack) > shared:
+                board.pop()
+            sans = gameSans
+            for san in gameSans[shared:]:
+                board.push(board.parse_san(san))
+        except ValueError:
+            board = None
+            yield read_pgn_game(tags + movetext)
+            continue
+        yield epd, list(board.move_stack)
+
+
+def read_epd_lines(f):
+    """yields (epd, moves) pairs for the (extended) EPDs in the given text stream"""
+    for line in f:
+        line = line.strip()
+        if line:
+            if line.startswith("#"):  # ignore comments
+                continue
+            line = line.split(";")[0]  # ignore epd opcodes
+            epd, _, moves = line.partition("moves")
+            epd = epd.split()[:6]  # include potential move counters
+            if len(epd) == 6 and not (epd[4].isnumeric() and epd[5].isnumeric()):
+                epd = epd[:4]
+            epd = " ".join(epd)
+            epdMoves = []
+            for m in moves.split():
+                if not MOVE_RE.fullmatch(m):
+                    break
+                epdMoves.append(move_from_uci(m))
+            yield epd, epdMoves
+
+
+def position_info(epd, board):
+    # the transposition key ignores move counters, which cdb does not use either
+    return epd, popcount(board.occupied), board._transposition_key()
+
+
+def ply_range(plyBegin, plyEnd, length):
+    """returns the plies from a line of the given length that are to be searched"""
+    plyB = (
+        0
+        if plyBegin is None
+        else max(0, plyBegin + length)
+        if plyBegin < 0
+        else min(plyBegin, length)
+    )
+    plyE = (
+        length
+        if plyEnd is None
+        else max(0, plyEnd + length)
+        if plyEnd < 0
+        else min(plyEnd, length)
+    )
+    return plyB, plyE
+
+
+def expand_lines(lines, plyBegin=-1, plyEnd=None, TBsearch=False):
+    """returns the number of lines and the EPDs found within their ply ranges"""
+    count, epds = 0, {}  # key the EPDs by their position to filter transpositions
+    board, stack = None, []  # board and (EPD, pieces, key) per ply of the previous line
+    for epd, moves in lines:
+        count += 1
+        moves = [None] + moves  # to be able to use plyBegin=0 for epd
+        plyB, plyE = ply_range(plyBegin, plyEnd, len(moves))
+        if plyB >= plyE:
+            continue  # no need to set up the board for an empty range
+        if board is None or stack[0][0] != epd:
+            board = chess.Board(epd)
+            stack = [position_info(epd, board)]
+        else:
+            # reuse the previous line, undoing only the moves not shared with it
+            shared = 0
+            for m, n in zip(board.move_stack, moves[1:]):
+                if m != n:
+                    break
+                shared += 1
+            while len(board.move_stack) > shared:
+                board.pop()
+            del stack[shared + 1 :]
         for ply, m in enumerate(moves):
-            if m is not None:
-                epd += f" {m}"
-                board.push(chess.Move.from_uci(m))
-            if not TBsearch and chess.popcount(board.occupied) <= CDB_EGTB:
+            if ply == len(stack):
+                board.push(m)
+                epd = stack[-1][0] + (" moves " if ply == 1 else " ") + m.uci()
+                stack.append(position_info(epd, board))
+            # the board may be ahead of ply, so use the values stored for it
+            epd, pieces, key = stack[ply]
+            if not TBsearch and pieces <= CDB_EGTB:
                 break
             if plyB <= ply and ply < plyE:
-                epds.add(epd)
+                epds.setdefault(key, epd)
             elif ply >= plyE:
                 break
-            if m is None:
-                epd += " moves"
-    epds = list(epds)
+    return count, epds
+
+
+def is_game_end(line):
+    """returns if the PGN line is movetext that ends with a game termination marker"""
+    if line[:1] in (b"[", b"%", b";"):
+        return False
+    line = line.rstrip()
+    if b"{" in line.rpartition(b"}")[2]:  # the line ends within a comment
+        return False
+    return line.endswith((b"1-0", b"0-1", b"1/2-1/2", b"*"))
+
+
+def split_file(filename, chunks, isPgn):
+    """returns byte offsets that split the file into chunks at line (PGN: game) boundaries"""
+    size = os.path.getsize(filename)
+    offsets = [0]
+    with open(filename, "rb") as f:
+        for i in range(1, chunks):
+            f.seek(max(i * size // chunks, offsets[-1]))
+            f.readline()  # skip to the start of the next line
+            prevBlank, prevEnd = False, False
+            while True:
+                pos = f.tell()
+                line = f.readline()
+                # Split PGNs at a tag that follows empty lines after movetext that
+                # ends with the result: a tag after an empty line alone may still
+                # belong to the same game, as one empty line is allowed between tags.
+                if (
+                    not line
+                    or not isPgn
+                    or (prevBlank and prevEnd and line[:1] == b"[")
+                ):
+                    break
+                if line.isspace():
+                    prevBlank = True
+                else:
+                    prevBlank = False
+                    prevEnd = is_game_end(line)
+            offsets.append(pos)
+    offsets.append(size)
+    return offsets
+
+
+def init_loader():
+    # a forked loader inherits the handlers of the main process, which would kill
+    # the search workers on a signal meant for the loader
+    for name in ["SIGINT", "SIGTERM", "SIGQUIT", "SIGBREAK"]:
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), signal.SIG_DFL)
+
+
+def load_chunk(filename, start, end, isPgn, plyBegin, plyEnd, TBsearch):
+    """returns the number of lines and the EPDs in the given byte range of the file"""
+    with open(filename, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    with io.TextIOWrapper(io.BytesIO(data), encoding="utf-8", errors="replace") as f:
+        lines = read_pgn_lines(f) if isPgn else read_epd_lines(f)
+        return expand_lines(lines, plyBegin, plyEnd, TBsearch)
+
+
+def load_epds(
+    filename,
+    plyBegin=-1,
+    plyEnd=None,
+    TBsearch=False,
+    concurrency=1,
+    gzipThreads=1,
+):
+    """returns a list of unique EPDs found in the given file"""
+    name = filename.lower()
+    isGz = name.endswith(".gz")
+    isPgn = name.endswith(".pgn") or name.endswith(".pgn.gz")
+    if concurrency <= 1:
+        with open_file_rt(filename, gzipThreads, isGz) as f:
+            lines = read_pgn_lines(f) if isPgn else read_epd_lines(f)
+            count, epds = expand_lines(lines, plyBegin, plyEnd, TBsearch)
+    else:
+        tmpname = None
+        try:
+            if isGz:
+                # decompress once, so that the workers can seek within the file
+                with tempfile.NamedTemporaryFile(delete=False) as fout:
+                    tmpname = fout.name
+                    with open_gzip_rb(filename, gzipThreads) as fin:
+                        shutil.copyfileobj(fin, fout)
+            name = filename if tmpname is None else tmpname
+            # use chunks of at most 64MB, to limit the memory used by each worker
+            chunks = max(concurrency, os.path.getsize(name) // 2**26 + 1)
+            offsets = split_file(name, chunks, isPgn)
+            count, epds = 0, {}
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=concurrency, initializer=init_loader
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        load_chunk,
+                        name,
+                        start,
+                        end,
+                        isPgn,
+                        plyBegin,
+                        plyEnd,
+                        TBsearch,
+                    )
+                    for start, end in zip(offsets, offsets[1:])
+                    if start < end
+                ]
+                for future in futures:
+                    c, e = future.result()
+                    count += c
+                    for key, epd in e.items():
+                        epds.setdefault(key, epd)
+        finally:
+            if tmpname is not None:
+                os.remove(tmpname)
+    if isPgn:
+        print(f"Loaded {count} (opening) lines from file {filename}.")
+    else:
+        print(f"Loaded {count} (extended) EPDs from file {filename}.")
+    epds = list(epds.values())
 
     print(f"Loaded {len(epds)} unique EPDs from file {filename}.")
     return epds
 
 
-class TaskCounter:
-    def __init__(self):
-        self._counter = 0
+def epds_cache_key(filename, plyBegin, plyEnd, TBsearch):
+    """returns a key that changes whenever the loaded EPDs may change"""
+    stat = os.stat(filename)
+    key = [EPDS_CACHE_VERSION, plyBegin, plyEnd, TBsearch]
+    key += [os.path.abspath(filename), stat.st_mtime_ns, stat.st_size]
+    return hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+
+
+def epds_cache_file(cacheDir, filename):
+    # one cache file per input file, so that outdated caches are overwritten
+    name = hashlib.blake2b(os.path.abspath(filename).encode(), digest_size=16)
+    suffix = ".pkl.gz" if zstandard is None else ".pkl.zst"
+    return os.path.join(os.path.expanduser(cacheDir), name.hexdigest() + suffix)
+
+
+def read_epds_cache(cacheDir, filename, key):
+    """returns the cached list of EPDs for filename if it has the given key, or None"""
+    filename = epds_cache_file(cacheDir, filename)
+    try:
+        with open(filename, "rb") as f:
+            data = f.read()
+        if zstandard is None:
+            data = gzip.decompress(data)
+        else:
+            data = zstandard.ZstdDecompressor().decompress(data)
+        cacheKey, epds = pickle.loads(data)
+        return epds if cacheKey == key else None
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        # an unreadable cache is simply a miss
+        print(f'Ignoring cache file {filename}: caught exception "{ex}"')
+        return None
+
 
-    def inc(self):
-        self._counter += 1
+def write_epds_cache(cacheDir, filename, key, epds):
+    data = pickle.dumps((key, epds), protocol=pickle.HIGHEST_PROTOCOL)
+    if zstandard is None:
+        data = gzip.compress(data, compresslevel=1)
+    else:
+        data = zstandard.ZstdCompressor(level=3).compress(data)
+    filename = epds_cache_file(cacheDir, filename)
+    tmpname = None
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # write to a temporary file first, so that the cache is never seen incomplete
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(filename), delete=False
+        ) as f:
+            tmpname = f.name
+            f.write(data)
+        os.replace(tmpname, filename)
+    except OSError as ex:
+        # the EPDs are loaded already, so continue without caching them
+        print(f'Could not write cache file {filename}: caught exception "{ex}"')
+        if tmpname is not None and os.path.exists(tmpname):
+            os.remove(tmpname)
 
-    def dec(self, fn):
-        self._counter -= 1
 
-    def get(self):
-        return self._counter
+def load_cached_epds(
+    key,
+    cacheDir,
+    filename,
+    plyBegin,
+    plyEnd,
+    TBsearch,
+    concurrency,
+    gzipThreads,
+):
+    """returns the list of unique EPDs found in filename, using the cache if possible"""
+    if cacheDir is not None:
+        epds = read_epds_cache(cacheDir, filename, key)
+        if epds is not None:
+            print(f"Loaded {len(epds)} unique EPDs for file {filename} from cache.")
+            return epds
+    epds = load_epds(filename, plyBegin, plyEnd, TBsearch, concurrency, gzipThreads)
+    if cacheDir is not None:
+        write_epds_cache(cacheDir, filename, key, epds)
+    return epds
 
 
 if __name__ == "__main__":
@@ -245,10 +675,49 @@ if __name__ == "__main__":
         action="store_true",
         help="Reload positions from filename when tasks for new cycle are needed.",
     )
+    argParser.add_argument(
+        "--loadConcurrency",
+        help="Number of processes used to parse filename. Values larger than one first decompress a filename with suffix .gz to a temporary file.",
+        type=int,
+        default=1,
+    )
+    argParser.add_argument(
+        "--gzipThreads",
+        help="Number of threads used to decompress a filename with suffix .gz. Values larger than one require rapidgzip or pgzip to be installed.",
+        type=int,
+        default=1,
+    )
+    argParser.add_argument(
+        "--cacheDir",
+        help="Directory in which to cache the positions loaded from filename, e.g. ~/.cache/cdbexplore. Later runs, and reloads, skip the parsing of unchanged files. Only the positions last loaded from filename are kept. Positions are never reparsed by --reload if filename is unchanged.",
+        default=None,
+    )
     args = argParser.parse_args()
 
-    def on_sigint(signal, frame):
+    # The workers of the executor, and any processes they spawn, share their own
+    # process group, so that they can all be terminated with a single signal.
+    # Windows does not have process groups.
+    workersGroup = multiprocessing.Value("i", 0) if hasattr(os, "killpg") else None
+
+    def kill_workers_group(sig):
+        try:
+            os.killpg(workersGroup.value, sig)
+            return True
+        except ProcessLookupError:
+            return False
+
+    def on_sigint(signum, frame):
         print("Received signal to terminate. Killing sub-processes.", flush=True)
+        if workersGroup is not None and workersGroup.value:
+            kill_workers_group(signal.SIGTERM)
+            deadline = time.monotonic() + 2
+            while time.monotonic() < deadline:
+                active_children()  # reaps the workers that have exited
+                if not kill_workers_group(0):
+                    break
+                time.sleep(0.05)
+            else:
+                kill_workers_group(signal.SIGKILL)
         for child in active_children():
             child.kill()
         print("Done.", flush=True)
@@ -268,13 +737,43 @@ if __name__ == "__main__":
         # Linux does not have SIGBREAK.
         pass
 
-    executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.bulkConcurrency)
+    # The workers send their output line by line through this queue, tagged with the
+    # task id. A SimpleQueue writes synchronously, so all the output of a task is in
+    # the queue before its future completes and appends the final (taskId, None).
+    # A separate thread drains the queue, so that the workers are never blocked by a
+    # full pipe, e.g. while the main thread reloads the positions.
+    outputQueue = multiprocessing.SimpleQueue()
+    output, finished = {}, set()  # buffer output of tasks not yet shown
+    outputCondition = threading.Condition()
+    outputThread = threading.Thread(
+        target=consume_output,
+        args=(outputQueue, output, finished, outputCondition),
+        daemon=True,
+    )
+    outputThread.start()
+    executor = concurrent.futures.ProcessPoolExecutor(
+        max_workers=args.bulkConcurrency,
+        initializer=init_worker,
+        initargs=(
+            outputQueue,
+            workersGroup,
+            args.timeLimit,
+            args.concurrency,
+            args.evalDecay,
+            args.cursedWins,
+            args.TBsearch,
+            args.proveMates,
+            args.user,
+            args.suppressErrors,
+        ),
+    )
     print(f"Positions to be explored with concurrency {args.bulkConcurrency}.")
 
     task, tasks = None, deque()
-    taskCounter = TaskCounter()
+    pending = set()  # futures of the submitted tasks that are not yet done
+    taskId = 0
     first = True
-    epdIdx, epds = 0, []
+    epdIdx, epds, epdsKey = 0, [], None
 
     while True:
         if epdIdx == len(epds):
@@ -282,9 +781,27 @@ if __name__ == "__main__":
             if first or args.forever:
                 if first or args.reload:
                     try:
-                        epds = load_epds(
-                            args.filename, args.plyBegin, args.plyEnd, args.TBsearch
+                        key = epds_cache_key(
+                            args.filename,
+                            args.plyBegin,
+                            args.plyEnd,
+                            args.TBsearch,
                         )
+                        if key == epdsKey:
+                            print(f"File {args.filename} is unchanged.")
+                            newEpds = list(epds)  # pending tasks refer to the old list
+                        else:
+                            newEpds = load_cached_epds(
+                                key,
+                                args.cacheDir,
+                                args.filename,
+                                args.plyBegin,
+                                args.plyEnd,
+                                args.TBsearch,
+                                args.loadConcurrency,
+                                args.gzipThreads,
+                            )
+                        epds, epdsKey = newEpds, key
                         if args.shuffle:
                             random.shuffle(epds)
                     except Exception:
@@ -306,31 +823,29 @@ if __name__ == "__main__":
                 break
         else:
             # Add some more tasks to the list if few are pending
-            if taskCounter.get() < 2 * args.bulkConcurrency:
+            if len(pending) < 2 * args.bulkConcurrency:
                 epd = epds[epdIdx]
                 future = executor.submit(
                     wrapcdbsearch,
+                    taskId=taskId,
                     epd=epd,
                     depthLimit=depthLimit,
-                    timeLimit=args.timeLimit,
-                    concurrency=args.concurrency,
-                    evalDecay=args.evalDecay,
-                    cursedWins=args.cursedWins,
-                    TBsearch=args.TBsearch,
-                    proveMates=args.proveMates,
-                    user=args.user,
-                    suppressErrors=args.suppressErrors,
                 )
-                taskCounter.inc()
-                future.add_done_callback(taskCounter.dec)
+                pending.add(future)
+                future.add_done_callback(pending.discard)
+                future.add_done_callback(
+                    lambda fn, i=taskId: outputQueue.put((i, None))
+                )
                 tasks.append(
                     (
                         epds,
                         epdIdx,
                         depthLimit,
                         future,
+                        taskId,
                     )
                 )
+                taskId += 1
                 epdIdx += 1
 
         if task is None:
@@ -342,15 +857,31 @@ if __name__ == "__main__":
                     flush=True,
                 )
         else:
-            # See if we have a result, if not continue.
-            try:
-                print(task[3].result(timeout=0.01), flush=True)
-                task = None
-            except concurrent.futures.TimeoutError:
-                pass
-            except Exception as ex:
-                print(f' error: caught exception "{ex}"')
+            with outputCondition:
+                if (
+                    task[4] not in finished
+                    and task[4] not in output
+                    and (
+                        len(pending) >= 2 * args.bulkConcurrency
+                        or (epdIdx == len(epds) and not args.forever)
+                    )
+                ):
+                    # Sleep until some output arrives, unless new tasks can be added.
+                    outputCondition.wait()
+                text = "".join(output.pop(task[4], []))
+                done = task[4] in finished
+                finished.discard(task[4])
+            if text:
+                print(text, end="", flush=True)
+            if done:
+                try:
+                    task[3].result()
+                    print(flush=True)
+                except Exception as ex:
+                    print(f' error: caught exception "{ex}"')
                 task = None
 
     executor.shutdown()
+    outputQueue.put(None)
+    outputThread.join()
     print(f"Done processing {args.filename}.")